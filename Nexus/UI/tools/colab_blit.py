@@ -0,0 +1,28 @@
+
+try:
+    # Optional: compiles the batch blit into a native kernel
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+if njit is not None:
+    # Compiled eagerly for these exact argument types when the module is imported (and cached on disk),
+    # so the first flush never stalls the event loop on JIT compilation.
+    @njit("void(uint8[::1], int64, uint8[::1], int64[:, ::1])", cache=True)
+    def blit_tiles(framebuffer_flat, framebuffer_width, pixels_flat, tiles):
+        # Copies a batch of RGBA tiles into a flattened (height * width * 4) uint8 framebuffer.
+        # Row i of `tiles` is (x, y, width, height); the tiles' pixels are packed back to back in
+        # `pixels_flat` in the same order. Tiles are copied in order, so later ones win where they overlap.
+        src = 0
+        for i in range(tiles.shape[0]):
+            x = tiles[i, 0]
+            y = tiles[i, 1]
+            row_bytes = tiles[i, 2] * 4
+            for row in range(tiles[i, 3]):
+                dst = ((y + row) * framebuffer_width + x) * 4
+                framebuffer_flat[dst:dst + row_bytes] = pixels_flat[src:src + row_bytes]
+                src += row_bytes
+else:
+    # Without numba a batched copy is no faster than copying each tile as it arrives, so callers do that instead
+    blit_tiles = None
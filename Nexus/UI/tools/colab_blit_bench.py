@@ -0,0 +1,52 @@
+
+import time
+import numpy as np
+from colab_blit import blit_tiles
+from colab_ui_test import MockWindow
+
+# A 1080p-sized window (height rounded down to a multiple of the tile size) fully covered by 16x16 RGBA tiles
+WIDTH = 1920
+HEIGHT = 1072
+TILE = 16
+RUNS = 5
+
+def make_tiles():
+    rng = np.random.default_rng(0)
+    return [
+        (x, y, rng.integers(0, 256, TILE * TILE * 4, dtype=np.uint8).tobytes())
+        for y in range(0, HEIGHT, TILE)
+        for x in range(0, WIDTH, TILE)
+    ]
+
+def bench_direct(tiles):
+    # Baseline: every tile copied into the framebuffer with numpy as it arrives
+    framebuffer = np.zeros((HEIGHT, WIDTH, 4), dtype=np.uint8)
+    start = time.perf_counter()
+    for x, y, pixels in tiles:
+        framebuffer[y:y+TILE, x:x+TILE] = np.frombuffer(pixels, dtype=np.uint8).reshape((TILE, TILE, 4))
+    return time.perf_counter() - start, framebuffer
+
+def bench_window(tiles):
+    # The renderer's path: DrawToSurface for every tile, then the flush done before each frame
+    window = MockWindow(1, "bench", WIDTH, HEIGHT)
+    start = time.perf_counter()
+    for x, y, pixels in tiles:
+        window.draw_to_surface(x, y, TILE, TILE, pixels)
+    window.flush_tiles()
+    return time.perf_counter() - start, window.framebuffer
+
+def best_of(bench, tiles):
+    bench(tiles) # Warm-up
+    results = [bench(tiles) for _ in range(RUNS)]
+    return min(seconds for seconds, _ in results), results[0][1]
+
+if __name__ == "__main__":
+    tiles = make_tiles()
+    direct_seconds, direct_framebuffer = best_of(bench_direct, tiles)
+    window_seconds, window_framebuffer = best_of(bench_window, tiles)
+    assert np.array_equal(direct_framebuffer, window_framebuffer), "MockWindow produced a different frame"
+
+    print(f"{len(tiles)} tiles of {TILE}x{TILE} into {WIDTH}x{HEIGHT}, best of {RUNS} runs")
+    print(f"  direct numpy copies: {direct_seconds * 1000:.2f} ms")
+    print(f"  MockWindow ({'numba batch' if blit_tiles is not None else 'direct, numba not installed'}): "
+          f"{window_seconds * 1000:.2f} ms")
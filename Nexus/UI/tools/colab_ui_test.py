@@ -1,11 +1,39 @@
 
 import asyncio
-import base64
 import json
+import threading
 import numpy as np
+from array import array
 from PIL import Image
 from io import BytesIO
 from IPython.display import display, Image as IPImage, clear_output
+from colab_blit import blit_tiles
+
+try:
+    # Optional: SIMD-accelerated drop-in replacement for base64, used for JSON DrawToSurface payloads
+    import pybase64 as base64
+except ImportError:
+    import base64
+
+try:
+    # Optional: encodes JPEG straight from the RGBA framebuffer without going through PIL
+    import simplejpeg
+except ImportError:
+    simplejpeg = None
+
+# Display frame budget: draws are coalesced into at most ~30 renders per second
+FRAME_INTERVAL = 1 / 30
+# Frames are shown as JPEG: skipping PNG's deflate step is far cheaper for a local viewer
+JPEG_QUALITY = 80
+# Bytes per pixel of each DrawToSurface pixel format. RGB and RGBX are opaque: their alpha is forced to 255,
+# so opaque sources can skip sending alpha (RGB) or send a padding byte that is ignored (RGBX).
+PIXEL_FORMAT_CHANNELS = {"RGBA": 4, "RGBX": 4, "RGB": 3}
+
+def split_planes(rgba):
+    # AoS (h, w, 4) uint8 -> contiguous SoA (4, h, w) uint16 planes, wide enough for blend arithmetic.
+    # Per-channel math on unit-stride planes vectorizes far better than on interleaved RGBA.
+    return np.moveaxis(rgba, -1, 0).astype(np.uint16, order='C')
+
 
 # Mock representation of a window
 class MockWindow:
@@ -14,22 +42,143 @@ class MockWindow:
         self.title = title
         self.width = width
         self.height = height
-        self.framebuffer = np.zeros((height, width, 4), dtype=np.uint8) # RGBA
+        # RGBA. Partial RGBA tiles from draw_to_surface only land here on flush_tiles(),
+        # so direct readers should flush first (get_image() does).
+        self.framebuffer = np.zeros((height, width, 4), dtype=np.uint8)
+        # The framebuffer is never reallocated, so one PIL image aliasing its memory
+        # (frombuffer, unlike fromarray, does not copy) sees every draw and is reused for every render.
+        self._image = Image.frombuffer('RGBA', (width, height), self.framebuffer, 'raw', 'RGBA', 0, 1)
+        self._image.readonly = 0 # Let PIL write through to the framebuffer instead of copying first
+        self.drawn = False # Whether anything has ever been drawn to this window
+        self.dirty = False # Whether it changed since it was last displayed
+        self._pending_tiles = [] # Pixel buffers of the RGBA tiles waiting for flush_tiles(), in draw order
+        self._pending_rects = array('q') # Their (x, y, width, height), flattened
+
+    def draw_to_surface(self, x, y, width, height, pixels, pixel_format="RGBA"):
+        if pixel_format not in PIXEL_FORMAT_CHANNELS:
+            raise ValueError(f"Unsupported pixel format: {pixel_format}")
+        channels = PIXEL_FORMAT_CHANNELS[pixel_format]
+        # Validated up front for every path, so a bad request fails cleanly instead of writing out of place
+        # (negative offsets are valid numpy slices) or being broadcast (np.copyto) or deferred (queued tiles).
+        self.check_rect(x, y, width, height)
+        if len(pixels) != width * height * channels:
+            raise ValueError(f"Expected {width * height * channels} bytes of {pixel_format} pixel data, got {len(pixels)}")
+
+        if pixel_format != "RGBA":
+            # Opaque formats: copy the colour channels and force alpha to 255
+            self.flush_tiles()
+            pixels_np = np.frombuffer(pixels, dtype=np.uint8).reshape((height, width, channels))
+            region = self.framebuffer[y:y+height, x:x+width]
+            region[..., :3] = pixels_np[..., :3]
+            region[..., 3] = 255
+            self.mark_dirty()
+            return
+
+        if x == 0 and y == 0 and width == self.width and height == self.height:
+            # Full-window tile: a single flat memcpy into the framebuffer, no reshape or 2-D slicing.
+            # It overwrites every pending tile, so those are simply dropped.
+            np.copyto(self.framebuffer.reshape(-1), np.frombuffer(pixels, dtype=np.uint8))
+            self._pending_tiles = []
+            self._pending_rects = array('q')
+            self.mark_dirty()
+            return
+
+        if blit_tiles is None:
+            # Without the compiled batch kernel, copying the tile right away is the cheapest option
+            self.blit(x, y, np.frombuffer(pixels, dtype=np.uint8).reshape((height, width, 4)))
+            return
+        self.queue_tile(x, y, width, height, pixels)
 
-    def draw_to_surface(self, x, y, width, height, pixels):
-        # Convert flattened RGBA byte array to numpy array
-        pixels_np = np.array(pixels, dtype=np.uint8).reshape((height, width, 4))
+    def queue_tile(self, x, y, width, height, pixels):
+        # Partial RGBA tiles are batched and copied by a single blit_tiles call on the next flush.
+        # draw_to_surface has already validated them, while the error can still be reported to the sender.
+        # Queueing is kept to two appends so the per-tile Python cost stays below a direct numpy copy.
+        self._pending_tiles.append(pixels)
+        self._pending_rects.extend((x, y, width, height))
+        self.mark_dirty()
+
+    def check_rect(self, x, y, width, height):
+        if x < 0 or y < 0 or x + width > self.width or y + height > self.height:
+            raise ValueError(f"Tile {width}x{height} at ({x}, {y}) is outside the {self.width}x{self.height} window")
+
+    def flush_tiles(self):
+        if not self._pending_tiles:
+            return
+        # One C-level join packs every tile's pixels back to back; bytearray keeps the result writable,
+        # as the compiled kernel's signature expects.
+        pixels_flat = np.frombuffer(bytearray().join(self._pending_tiles), dtype=np.uint8)
+        tiles = np.frombuffer(self._pending_rects, dtype=np.int64).reshape((-1, 4))
+        self._pending_tiles = []
+        self._pending_rects = array('q')
+        blit_tiles(self.framebuffer.reshape(-1), self.width, pixels_flat, tiles)
+
+    def blit(self, x, y, pixels_np):
+        self.flush_tiles()
+        height, width = pixels_np.shape[:2]
         # Copy pixels to the window's framebuffer
         self.framebuffer[y:y+height, x:x+width] = pixels_np
+        self.mark_dirty()
+
+    def composite(self, other, x=0, y=0):
+        # Blend another window's framebuffer over this one at (x, y) ("source over").
+        # The framebuffer stays interleaved RGBA (what PIL, the JPEG encoders and the wire use);
+        # only the blend itself runs on SoA planes.
+        if x < 0 or y < 0:
+            raise ValueError(f"Composite offset ({x}, {y}) must not be negative")
+        width = min(other.width, self.width - x)
+        height = min(other.height, self.height - y)
+        if width <= 0 or height <= 0:
+            return
+
+        self.flush_tiles()
+        other.flush_tiles()
+        dst = self.framebuffer[y:y+height, x:x+width]
+        top = split_planes(other.framebuffer[:height, :width])
+        bottom = split_planes(dst)
+        src_alpha = top[3]
+        inv_alpha = 255 - src_alpha
+
+        out = np.empty_like(top)
+        out[:3] = (top[:3] * src_alpha + bottom[:3] * inv_alpha + 127) // 255
+        out[3] = src_alpha + (bottom[3] * inv_alpha + 127) // 255
+        dst[...] = np.moveaxis(out, 0, -1)
+        self.mark_dirty()
+
+    def mark_dirty(self):
+        self.drawn = True
+        self.dirty = True
+
+    def mark_clean(self):
+        self.dirty = False
 
     def get_image(self):
-        return Image.fromarray(self.framebuffer, 'RGBA')
+        self.flush_tiles()
+        return self._image
+
+    def image_view(self):
+        # Same view as get_image() without flushing queued tiles, for the render worker thread:
+        # the render loop has already flushed, and flushing there would race with new draws.
+        return self._image
 
 
 class ColabUIRenderer:
     def __init__(self):
         self.windows = {}
         self.next_window_id = 1
+        self.displayed_window_id = None
+        self._windows_response = None # Cached GetWindows response, reset whenever a window is created or closed
+        self._render_pending = asyncio.Event()
+        self._render_task = None
+        self._encode_buf = BytesIO() # Reused by every PIL encode instead of allocating per frame
+        # Encodes run on worker threads (render_all_windows) and on the caller's thread (render_all_windows_sync)
+        self._encode_lock = threading.Lock()
+        # Request type -> handler taking the request payload; one dict lookup per message instead of an if/elif chain
+        self._handlers = {
+            "CreateWindow": self._create_window,
+            "DrawToSurface": self._draw_to_surface,
+            "CloseWindow": self._close_window,
+            "GetWindows": self._get_windows,
+        }
         print("Colab UI Renderer initialized.")
 
     async def handle_request(self, request):
@@ -38,81 +187,155 @@ class ColabUIRenderer:
         
         print(f"Renderer: Received request type: {req_type}")
 
-        if req_type == "CreateWindow":
-            window_id = self.next_window_id
-            self.next_window_id += 1
-            window = MockWindow(window_id, payload["title"], payload["width"], payload["height"])
-            self.windows[window_id] = window
-            print(f"Renderer: Created window {window_id} - '{window.title}' ({window.width}x{window.height})")
-            return {"type": "Success", "payload": {"window_id": window_id}}
+        handler = self._handlers.get(req_type)
+        if handler is None:
+            print(f"Renderer: Unknown request type: {req_type}")
+            return {"type": "Error", "payload": {"message": f"Unknown request type: {req_type}"}}
+        return handler(payload)
+
+    def _create_window(self, payload):
+        window_id = self.next_window_id
+        self.next_window_id += 1
+        window = MockWindow(window_id, payload["title"], payload["width"], payload["height"])
+        self.windows[window_id] = window
+        self._windows_response = None
+        print(f"Renderer: Created window {window_id} - '{window.title}' ({window.width}x{window.height})")
+        return {"type": "Success", "payload": {"window_id": window_id}}
 
-        elif req_type == "DrawToSurface":
-            window_id = payload["window_id"]
-            x, y, width, height = payload["x"], payload["y"], payload["width"], payload["height"]
-            pixels_b64 = payload["pixels"]
-            pixels = base64.b64decode(pixels_b64)
-
-            if window_id in self.windows:
-                self.windows[window_id].draw_to_surface(x, y, width, height, pixels)
-                self.render_all_windows()
-                return {"type": "Success", "payload": {"window_id": window_id}}
-            else:
-                print(f"Renderer: Error - Window {window_id} not found for DrawToSurface.")
-                return {"type": "Error", "payload": {"message": f"Window {window_id} not found"}}
-
-        elif req_type == "CloseWindow":
-            window_id = payload["window_id"]
-            if window_id in self.windows:
-                del self.windows[window_id]
-                print(f"Renderer: Closed window {window_id}.")
-                self.render_all_windows()
-                return {"type": "Success", "payload": {"window_id": window_id}}
-            else:
-                print(f"Renderer: Error - Window {window_id} not found for CloseWindow.")
-                return {"type": "Error", "payload": {"message": f"Window {window_id} not found"}}
-
-        elif req_type == "GetWindows":
-            window_infos = []
-            for win_id, win in self.windows.items():
-                window_infos.append({
-                    "id": win.id,
-                    "title": win.title,
-                    "x": 0, # Simplified, actual pos not tracked by MockWindow
-                    "y": 0,
-                    "width": win.width,
-                    "height": win.height,
-                })
-            return {"type": "Windows", "payload": window_infos}
+    def _draw_to_surface(self, payload):
+        window_id = payload["window_id"]
+        x, y, width, height = payload["x"], payload["y"], payload["width"], payload["height"]
+        pixels = payload["pixels"]
+        pixel_format = payload.get("format", "RGBA")
+        if isinstance(pixels, str):
+            # JSON clients send base64-encoded pixels; binary frames arrive as raw bytes
+            pixels = base64.b64decode(pixels, validate=False)
 
+        if window_id in self.windows:
+            self.windows[window_id].draw_to_surface(x, y, width, height, pixels, pixel_format)
+            self.request_render()
+            return {"type": "Success", "payload": {"window_id": window_id}}
         else:
-            print(f"Renderer: Unknown request type: {req_type}")
-            return {"type": "Error", "payload": {"message": f"Unknown request type: {req_type}"}}
+            print(f"Renderer: Error - Window {window_id} not found for DrawToSurface.")
+            return {"type": "Error", "payload": {"message": f"Window {window_id} not found"}}
+
+    def _close_window(self, payload):
+        window_id = payload["window_id"]
+        if window_id in self.windows:
+            del self.windows[window_id]
+            self._windows_response = None
+            print(f"Renderer: Closed window {window_id}.")
+            self.request_render()
+            return {"type": "Success", "payload": {"window_id": window_id}}
+        else:
+            print(f"Renderer: Error - Window {window_id} not found for CloseWindow.")
+            return {"type": "Error", "payload": {"message": f"Window {window_id} not found"}}
+
+    def _get_windows(self, payload):
+        # Window metadata only changes on create/close, so polling returns the same (shared, read-only) response
+        if self._windows_response is not None:
+            return self._windows_response
+
+        window_infos = []
+        for win_id, win in self.windows.items():
+            window_infos.append({
+                "id": win.id,
+                "title": win.title,
+                "x": 0, # Simplified, actual pos not tracked by MockWindow
+                "y": 0,
+                "width": win.width,
+                "height": win.height,
+            })
+        self._windows_response = {"type": "Windows", "payload": window_infos}
+        return self._windows_response
+
+    async def submit_tile(self, window_id, x, y, width, height, pixels_np):
+        # In-process path for local V-nodes: pixels arrive as a numpy array and skip WebSocket, JSON and base64
+        if window_id not in self.windows:
+            print(f"Renderer: Error - Window {window_id} not found for submit_tile.")
+            return {"type": "Error", "payload": {"message": f"Window {window_id} not found"}}
+        if pixels_np.dtype != np.uint8:
+            raise ValueError(f"Expected uint8 RGBA pixels, got {pixels_np.dtype}")
+        window = self.windows[window_id]
+        window.check_rect(x, y, width, height)
+        window.blit(x, y, pixels_np.reshape((height, width, 4)))
+        self.request_render()
+        return {"type": "Success", "payload": {"window_id": window_id}}
 
-    def render_all_windows(self):
+    def request_render(self):
+        # Renders happen on the frame loop, so a burst of draws only re-encodes the display once
+        if self._render_task is None or self._render_task.done():
+            self._render_task = asyncio.get_running_loop().create_task(self._render_loop())
+        self._render_pending.set()
+
+    async def _render_loop(self):
+        while True:
+            await self._render_pending.wait()
+            await asyncio.sleep(FRAME_INTERVAL)
+            self._render_pending.clear()
+            try:
+                await self.render_all_windows()
+            except Exception as e:
+                print(f"Renderer: Error while rendering: {e}")
+
+    async def render_all_windows(self):
+        window = self._window_to_render()
+        if window is not None:
+            # Encoding runs on a worker thread so the event loop keeps servicing WebSocket traffic
+            img_bytes = await asyncio.to_thread(self.encode_window, window)
+            self._show_frame(window, img_bytes)
+
+    def render_all_windows_sync(self):
+        # For callers outside the event loop; encodes on the calling thread
+        window = self._window_to_render()
+        if window is not None:
+            self._show_frame(window, self.encode_window(window))
+
+    def _window_to_render(self):
+        # Returns the window whose frame has to be (re-)encoded, or None when there is nothing new to show
         if not self.windows:
+            self.displayed_window_id = None
             clear_output(wait=True)
             print("No windows to display.")
-            return
+            return None
+
+        # Land all batched tiles before anything is encoded
+        for window in self.windows.values():
+            window.flush_tiles()
+
+        # For simplicity, just display the first window that has been drawn to
+        # In a real scenario, you'd composite all windows onto a single canvas.
+        # Draws flag their window, so there is no need to scan framebuffers for non-zero pixels.
+        first_drawn_window = next((w for w in self.windows.values() if w.drawn), None)
+
+        if first_drawn_window is None:
+            self.displayed_window_id = None
+            clear_output(wait=True)
+            print("Windows created, but no drawing operations yet.")
+            return None
+
+        if first_drawn_window.id == self.displayed_window_id and not first_drawn_window.dirty:
+            return None # Already on screen and unchanged, skip the re-encode
+
+        # Cleared before encoding so draws that land while the frame is encoded mark it dirty again
+        first_drawn_window.mark_clean()
+        return first_drawn_window
+
+    def _show_frame(self, window, img_bytes):
+        clear_output(wait=True)
+        display(IPImage(data=img_bytes))
+        self.displayed_window_id = window.id
 
-        with BytesIO() as buffer:
-            # For simplicity, just display the first window that has been drawn to
-            # In a real scenario, you'd composite all windows onto a single canvas.
-            first_drawn_window = None
-            for window in self.windows.values():
-                # Check if the framebuffer actually contains non-zero pixel data (i.e., something was drawn)
-                if np.any(window.framebuffer != 0):
-                    first_drawn_window = window
-                    break
-            
-            if first_drawn_window:
-                img = first_drawn_window.get_image()
-                img.save(buffer, format="PNG")
-                buffer.seek(0)
-                clear_output(wait=True)
-                display(IPImage(data=buffer.getvalue()))
-            else:
-                clear_output(wait=True)
-                print("Windows created, but no drawing operations yet.")
+    def encode_window(self, window):
+        if simplejpeg is not None:
+            return simplejpeg.encode_jpeg(window.framebuffer, quality=JPEG_QUALITY, colorspace='RGBA')
+        # JPEG has no alpha channel, so drop it before encoding
+        img = window.image_view().convert('RGB')
+        with self._encode_lock:
+            self._encode_buf.seek(0)
+            self._encode_buf.truncate(0)
+            img.save(self._encode_buf, format="JPEG", quality=JPEG_QUALITY)
+            return self._encode_buf.getvalue()
 
 
 # Global renderer instance
@@ -124,7 +347,7 @@ async def process_ipc_message(message):
 # Helper to trigger initial display if needed
 def start_ui_renderer():
     print("Colab UI Renderer ready to process IPC messages.")
-    renderer.render_all_windows() # Initial empty display
+    renderer.render_all_windows_sync() # Initial empty display
 
 # Call this from your notebook to start the mock renderer loop
 # asyncio.create_task(start_ui_renderer())
@@ -1,39 +1,159 @@
 
 import asyncio
+import functools
 import websockets
 import json
+import struct
+import msgpack
+
+try:
+    # Optional: uvloop's event loop is considerably faster for websockets servers.
+    # This only applies to loops created after import (e.g. asyncio.run), not an already running notebook loop.
+    import uvloop
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+except ImportError:
+    pass
 
 # Assuming colab_ui_test.py is in the same directory and has `renderer` and `process_ipc_message` defined.
 # For a true isolated module, you'd import specific functions.
-from colab_ui_test import process_ipc_message, renderer
+from colab_ui_test import process_ipc_message, renderer, start_ui_renderer
 
 # In-memory channel for simulated IPC from kernel/V-nodes to the Colab UI
 # This simulates the IPC channel where the kernel/compositor would send messages
 # which are then picked up by the WebSocket server.
+# V-nodes running in this process put (window_id, x, y, width, height, pixels_np) tiles on it,
+# which are blitted directly without going through WebSocket, JSON or base64.
 ipc_message_queue = asyncio.Queue()
 
+# Capacity of the per-connection response queue, and the most responses coalesced into one frame
+MAX_BATCH = 64
+
+# Received messages buffered per connection, both by websockets and in the inbox; each can be up to
+# MAX_MESSAGE_SIZE, so this stays small and a fast sender waits on the worker instead.
+INBOX_SIZE = 4
+
+# Largest accepted WebSocket message; the websockets default (1 MiB) is smaller than a single 1080p RGBA frame.
+# 16 MiB fits a full 2560x1440 RGBA frame (about 14 MiB) or a base64 JSON 1080p frame (about 11 MiB).
+MAX_MESSAGE_SIZE = 16 * 1024 * 1024
+
+def decode_binary_frame(message):
+    # Binary frames carry DrawToSurface pixels without base64:
+    # [4-byte big-endian header length][JSON header][raw RGBA bytes]
+    (header_len,) = struct.unpack_from("!I", message)
+    request = json.loads(message[4:4 + header_len])
+    if not isinstance(request, dict) or not isinstance(request.setdefault("payload", {}), dict):
+        raise ValueError("Invalid binary frame header")
+    # Hand the pixel bytes to the renderer as a view over the received frame (no copy)
+    request["payload"]["pixels"] = memoryview(message)[4 + header_len:]
+    return request
+
+def decode_message(message, subprotocol):
+    if subprotocol == "msgpack":
+        # MessagePack carries pixels as a native bin field, so no base64 or framing is needed
+        return msgpack.unpackb(message, raw=False)
+    if isinstance(message, bytes):
+        return decode_binary_frame(message)
+    # Attempt to parse as JSON. This is how V-nodes would communicate.
+    return json.loads(message)
+
+# Last encoded GetWindows frame per subprotocol, as (response, frame). The renderer keeps handing out
+# the same response object until a window is created or closed, so identity means "unchanged".
+_windows_frames = {}
+
+def encode_response(response, subprotocol):
+    if response["type"] == "Success":
+        return encode_success(response["payload"]["window_id"], subprotocol)
+    if response["type"] == "Windows":
+        cached = _windows_frames.get(subprotocol)
+        if cached is None or cached[0] is not response:
+            cached = _windows_frames[subprotocol] = (response, serialize(response, subprotocol))
+        return cached[1]
+    return serialize(response, subprotocol)
+
+def serialize(response, subprotocol):
+    if subprotocol == "msgpack":
+        return msgpack.packb(response, use_bin_type=True)
+    return json.dumps(response)
+
+@functools.lru_cache(maxsize=256)
+def encode_success(window_id, subprotocol):
+    # Success responses only differ by window_id, so each encoded frame is built once and reused
+    return serialize({"type": "Success", "payload": {"window_id": window_id}}, subprotocol)
+
+def encode_batch(responses, subprotocol):
+    # A lone response is sent as-is so request/response clients see no difference
+    if len(responses) == 1:
+        return encode_response(responses[0], subprotocol)
+    return encode_response({"type": "Batch", "responses": responses}, subprotocol)
+
+async def process_message(message, protocol):
+    print(f"Received message from client: {message[:100]}...") # Log first 100 chars
+    try:
+        parsed_message = decode_message(message, protocol)
+    except Exception as e:
+        # Anything a client can send must yield an Error response rather than stop the connection,
+        # e.g. a text frame on a msgpack connection (TypeError) or a truncated frame (struct.error)
+        print(f"Received malformed message: {e}")
+        return {"type": "Error", "payload": {"message": "Invalid message"}}
+
+    try:
+        # Simulate kernel IPC by processing the message via the renderer
+        return await process_ipc_message(parsed_message)
+    except Exception as e:
+        print(f"Error processing message: {e}")
+        return {"type": "Error", "payload": {"message": str(e)}}
+
+# Each connection runs as a pipeline of three coroutines joined by queues, so reading message N+1,
+# handling message N and sending earlier responses overlap. None marks the end of each queue and is
+# only sent on a clean finish; a stage that fails is handled by handle_websocket tearing down the rest.
+
+async def read_messages(websocket, inbox):
+    # Producer: only pulls frames off the socket
+    async for message in websocket:
+        await inbox.put(message)
+    await inbox.put(None)
+
+async def handle_messages(inbox, outbox, protocol):
+    # Worker: decodes and dispatches requests in arrival order
+    while (message := await inbox.get()) is not None:
+        await outbox.put(await process_message(message, protocol))
+    await outbox.put(None)
+
+async def write_responses(websocket, outbox, protocol):
+    # Consumer: every response that is ready by the time the socket is free goes out in one frame
+    while True:
+        responses = [await outbox.get()]
+        while len(responses) < MAX_BATCH and responses[-1] is not None:
+            try:
+                responses.append(outbox.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+
+        closed = responses[-1] is None
+        if closed:
+            responses.pop()
+        if responses:
+            await websocket.send(encode_batch(responses, protocol))
+            print(f"Sent {len(responses)} response(s) to client: {str(responses)[:100]}...")
+        if closed:
+            return
+
 async def handle_websocket(websocket, path):
     print(f"WebSocket connection established: {path}")
+    # Negotiated once per connection: "msgpack", "json" or None (plain JSON)
+    protocol = websocket.subprotocol
+    inbox = asyncio.Queue(maxsize=INBOX_SIZE)
+    outbox = asyncio.Queue(maxsize=MAX_BATCH)
+    stages = [
+        asyncio.create_task(read_messages(websocket, inbox)),
+        asyncio.create_task(handle_messages(inbox, outbox, protocol)),
+        asyncio.create_task(write_responses(websocket, outbox, protocol)),
+    ]
     try:
-        async for message in websocket:
-            print(f"Received message from client: {message[:100]}...") # Log first 100 chars
-            try:
-                # Attempt to parse as JSON. This is how V-nodes would communicate.
-                parsed_message = json.loads(message)
-                
-                # Simulate kernel IPC by processing the message via the renderer
-                response = await process_ipc_message(parsed_message)
-                
-                # Send response back to the client
-                await websocket.send(json.dumps(response))
-                print(f"Sent response to client: {json.dumps(response)[:100]}...")
-
-            except json.JSONDecodeError:
-                print("Received non-JSON message.")
-                await websocket.send(json.dumps({"type": "Error", "payload": {"message": "Invalid JSON"}}))
-            except Exception as e:
-                print(f"Error processing message: {e}")
-                await websocket.send(json.dumps({"type": "Error", "payload": {"message": str(e)}}))
+        # Returns once every stage has finished cleanly, or as soon as one fails
+        done, _ = await asyncio.wait(stages, return_when=asyncio.FIRST_EXCEPTION)
+        for stage in done:
+            stage.result() # Re-raise the failure (e.g. ConnectionClosedError) for the handlers below
 
     except websockets.exceptions.ConnectionClosedOK:
         print("WebSocket connection closed normally.")
@@ -42,16 +162,41 @@ async def handle_websocket(websocket, path):
     except Exception as e:
         print(f"An unexpected error occurred in WebSocket handler: {e}")
     finally:
+        # A failed stage would leave the others blocked on their queues forever
+        for stage in stages:
+            stage.cancel()
         print(f"WebSocket connection terminated: {path}")
 
 
+async def drain_ipc_queue():
+    while True:
+        item = await ipc_message_queue.get()
+        try:
+            window_id, x, y, width, height, pixels_np = item
+            await renderer.submit_tile(window_id, x, y, width, height, pixels_np)
+        except Exception as e:
+            print(f"Error processing queued tile: {e}")
+
+
 async def start_websocket_server(port=8765):
     # Ensure the renderer is initialized and its display method doesn't block
-    renderer.start_ui_renderer() 
+    start_ui_renderer()
 
-    server = await websockets.serve(handle_websocket, "0.0.0.0", port)
+    ipc_task = asyncio.create_task(drain_ipc_queue())
+    # Per-message deflate is disabled: raw pixel frames barely compress, so it only burns CPU on both ends.
+    # Binary frames (raw pixels, MessagePack) are also never UTF-8 decoded or validated, unlike text frames.
+    server = await websockets.serve(
+        handle_websocket, "0.0.0.0", port,
+        subprotocols=["msgpack", "json"],
+        compression=None,
+        max_size=MAX_MESSAGE_SIZE,
+        max_queue=INBOX_SIZE,
+    )
     print(f"WebSocket server started on ws://0.0.0.0:{port}")
-    await server.wait_closed()
+    try:
+        await server.wait_closed()
+    finally:
+        ipc_task.cancel()
 
 # Example usage in a Colab cell:
 # from google.colab import output